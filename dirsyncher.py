@@ -2,12 +2,33 @@
 
 
 import os
+import sys
+import stat
 import shutil
 import time
 import tempfile
 import argparse
 import subprocess
+import signal
+import shlex
+import errno
 import hashlib
+import json
+import fcntl
+import atexit
+import threading
+import collections
+import concurrent.futures
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
@@ -32,63 +53,326 @@ def copy_symlink(src, dest):
     os.symlink(link_target, dest)
     
 
+# copies the file with the given in-kernel copy function (copy_file_range
+# or sendfile). returns False if the kernel refused to copy the file.
+def kernel_copy(copy_chunk, src_fd, dest_fd):
+    copied = 0
+    while True:
+        try:
+            n = copy_chunk(src_fd, dest_fd, copied)
+        except OSError as e:
+            if copied == 0 and e.errno in KERNEL_COPY_ERRNOS:
+                return False
+            raise
+        if n == 0:
+            # some filesystems silently copy nothing instead of failing
+            return copied > 0 or os.fstat(src_fd).st_size == 0
+        copied += n
+
+def fast_copy(src, dest):
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        src_fd = fsrc.fileno()
+        dest_fd = fdest.fileno()
+        # copy_file_range avoids the user space copy and can even reflink on
+        # the same filesystem; sendfile also works across filesystems
+        done = hasattr(os, "copy_file_range") and kernel_copy(
+            lambda i, o, offset: os.copy_file_range(i, o, 1 << 30, offset, offset), src_fd, dest_fd)
+        if not done:
+            done = hasattr(os, "sendfile") and kernel_copy(
+                lambda i, o, offset: os.sendfile(o, i, offset, 1 << 30), src_fd, dest_fd)
+        if not done:
+            shutil.copyfileobj(fsrc, fdest, COPY_BUFFER_SIZE)
+    # keep the mtime so the next comparison can skip hashing
+    shutil.copystat(src, dest)
+    return dest
+
+
+# sshfs/FUSE round modification times, so we allow some slack
+MTIME_TOLERANCE_NS = 1_000_000_000
+
+# buffer size used when we have to copy the data through user space
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# errors that tell us that the kernel cannot copy between the given files
+KERNEL_COPY_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                      errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.ETXTBSY}
+
+# number of threads used to compare and copy files during the initial sync
+COPY_WORKERS = 16
+
+# changes to a file are only copied once it was quiet for this many seconds
+COPY_DELAY = 0.25
+
+# number of files whose last copied (size, mtime_ns) is remembered
+COPIED_SNAPSHOTS = 1024
+
+# file hashes are cached across runs as (size, mtime_ns, digest) per path,
+# with one cache file per synced source directory
+HASH_CACHE_DIRECTORY = os.path.expanduser("~/.cache/dirsyncher")
+hash_cache_file = None
+# hashes loaded from the cache file; entries move to hash_cache once used
+stored_hashes = {}
+hash_cache = {}
+hash_cache_lock = threading.Lock()
+
+
+def new_hash():
+    # xxh3 is considerably faster than the hashlib algorithms, but optional
+    if xxhash is not None:
+        return xxhash.xxh3_64()
+    return hashlib.blake2b(digest_size=16)
+
+def hash_name():
+    return "xxh3_64" if xxhash is not None else "blake2b-128"
+
+
+def read_hash_cache():
+    try:
+        with open(hash_cache_file) as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        return {}
+    # digests of another algorithm are useless to us
+    if isinstance(cache, dict) and cache.get("algorithm") == hash_name():
+        return cache.get("hashes", {})
+    return {}
+
+def load_hash_cache(source_dir):
+    global hash_cache_file
+    source_id = hashlib.blake2b(os.fsencode(os.path.abspath(source_dir)), digest_size=8).hexdigest()
+    hash_cache_file = os.path.join(HASH_CACHE_DIRECTORY, f"hashes-{source_id}.json")
+    hashes = read_hash_cache()
+    with hash_cache_lock:
+        stored_hashes.update(hashes)
+
+def save_hash_cache():
+    try:
+        os.makedirs(HASH_CACHE_DIRECTORY, exist_ok=True)
+        # another instance syncing the same directory may share the file, so
+        # we merge into its current contents while holding a lock
+        with open(hash_cache_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            hashes = read_hash_cache()
+            with hash_cache_lock:
+                # drop hashes of files that are gone, so the cache does not grow forever
+                for path in stored_hashes:
+                    if not os.path.lexists(path):
+                        hashes.pop(path, None)
+                hashes.update(hash_cache)
+            fd, temp_path = tempfile.mkstemp(dir=HASH_CACHE_DIRECTORY, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as temp_file:
+                    json.dump({"algorithm": hash_name(), "hashes": hashes}, temp_file)
+                os.replace(temp_path, hash_cache_file)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+    except OSError:
+        print(f"{bcolors.WARNING}[!] Could not write hash cache {hash_cache_file}!{bcolors.ENDC}")
+
+
 def hash_file(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as fd:
-        for chunk in iter(lambda: fd.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    # files with the same size and mtime as last time are not read again
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    with hash_cache_lock:
+        cached = hash_cache.get(path) or stored_hashes.pop(path, None)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            hash_cache[path] = cached
+            return cached[2]
+
+    digest = hash_file_contents(path)
+    with hash_cache_lock:
+        hash_cache[path] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+def hash_file_contents(fname, new_hash = new_hash):
+    file_hash = new_hash()
+    with open(fname, "rb", buffering=0) as fd:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                # only a hint; some FUSE filesystems do not support it
+                pass
+        # large reads into one reused buffer keep the per-chunk overhead low.
+        # (mmap would be faster, but crashes with SIGBUS if the file shrinks.)
+        buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while n := fd.readinto(buffer):
+            file_hash.update(view[:n])
+    return file_hash.hexdigest()
     
 
-def is_same_file(file_a, file_b):
+# compares two files by their metadata only; returns None if the contents
+# have to be compared to decide whether they are the same
+def compare_metadata(file_a, file_b, stat_a = None):
     try:
+        if stat_a is None:
+            stat_a = os.lstat(file_a)
+        stat_b = os.lstat(file_b)
+
         # of both are symlinks we need to compare the target
-        if os.path.islink(file_a) and os.path.islink(file_b):
+        if stat.S_ISLNK(stat_a.st_mode) and stat.S_ISLNK(stat_b.st_mode):
             return os.readlink(file_a) == os.readlink(file_b)
+    except FileNotFoundError:
+        return False
+
+    # if only one is a symlink we return false
+    if stat.S_ISLNK(stat_a.st_mode) or stat.S_ISLNK(stat_b.st_mode):
+        return False
+
+    # files of different size can never be the same
+    if stat_a.st_size != stat_b.st_size:
+        return False
 
-        # if only one is a symlink we return false
-        if os.path.islink(file_a) and not os.path.islink(file_b):
-            return False
-        if os.path.islink(file_b) and not os.path.islink(file_a):
-            return False
+    # same size and (roughly) same modification time: assume unchanged
+    if abs(stat_a.st_mtime_ns - stat_b.st_mtime_ns) < MTIME_TOLERANCE_NS:
+        return True
 
-        # if boths are actual files we compare the hash
-        return hash_file(file_a) == hash_file(file_b)
+    return None
+
+# like compare_metadata, but reuses the stat cached by the os.scandir entry
+def compare_entry(entry, dest):
+    try:
+        stat_a = entry.stat(follow_symlinks=False)
     except FileNotFoundError:
         return False
+    return compare_metadata(entry.path, dest, stat_a)
+
+def try_hash_file(fname, hash_file = hash_file):
+    try:
+        return hash_file(fname)
+    except FileNotFoundError:
+        return None
+
+def md5_file(fname):
+    return hash_file_contents(fname, hashlib.md5)
+
+# hashes the given files on the remote host, so that their contents do not
+# have to be read through sshfs. returns {relative path: md5 digest} or None
+# if the remote host could not be asked.
+def remote_md5sums(remote_host, remote_path, relpaths, control_path = None):
+    p = subprocess.run(ssh_command(remote_host, control_path) + [f"cd {shlex.quote(remote_path)} && xargs -0 md5sum -z --"],
+                       input=b"\0".join(os.fsencode(relpath) for relpath in relpaths),
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # xargs exits with 123 if md5sum failed for some (e.g., missing) files
+    if p.returncode not in (0, 123):
+        return None
+
+    digests = {}
+    # with -z the file names are not escaped, so we can take them as they are
+    for line in p.stdout.split(b"\0"):
+        if not line:
+            continue
+        digest, _, relpath = line.partition(b"  ")
+        digests[os.fsdecode(relpath)] = digest.decode()
+    # without any digest the failure is not about single files; e.g., the
+    # md5sum of BusyBox does not know -z
+    if p.returncode != 0 and not digests:
+        return None
+    return digests
+
+# compares the contents of the (source, dest) pairs. all pairs are hashed as
+# one batch, so both sides of a pair and many pairs are hashed concurrently.
+def compare_contents(executor, pairs, dest_dir, remote_host = None, remote_path = None, control_path = None):
+    remote_digests = None
+    if remote_host is not None and pairs:
+        relpaths = [dest[len(dest_dir) + 1:] for _, dest in pairs]
+        remote_digests = remote_md5sums(remote_host, remote_path, relpaths, control_path)
+
+    if remote_digests is None:
+        paths = [path for pair in pairs for path in pair]
+        digests = dict(zip(paths, executor.map(try_hash_file, paths)))
+        return [digests[source] is not None and digests[source] == digests[dest] for source, dest in pairs]
+
+    # md5sum is what every remote host has, so we hash the sources with md5 as well
+    local_digests = executor.map(lambda source: try_hash_file(source, md5_file), [source for source, _ in pairs])
+    return [digest is not None and digest == remote_digests.get(relpath)
+            for digest, relpath in zip(local_digests, relpaths)]
+
+# prepares the exclude patterns for is_excluded. with pyahocorasick all
+# patterns are matched in a single pass over the path.
+def compile_excludes(exclude_directories):
+    if ahocorasick is None or not exclude_directories:
+        return list(exclude_directories)
+    automaton = ahocorasick.Automaton()
+    for exclude in exclude_directories:
+        automaton.add_word(exclude, exclude)
+    automaton.make_automaton()
+    return automaton
 
 def is_excluded(exclude_directories, file):
+    if ahocorasick is not None and isinstance(exclude_directories, ahocorasick.Automaton):
+        for _ in exclude_directories.iter(file):
+            return True
+        return False
     for exclude in exclude_directories:
         if exclude in file:
             return True
     return False
 
-# this copies the directory while leaving the additional files 
-# that are already in the dest in place
-def copy_dir(source_dir, dest_dir, exclude_directories = []):
+# walks the source tree, creates all directories in the destination and
+# collects the (source entry, dest) pairs that have to be compared
+def collect_copy_jobs(source_dir, dest_dir, excludes, jobs, exclude_names = frozenset()):
     if not os.path.exists(dest_dir):
         os.mkdir(dest_dir)
 
-    for file in os.listdir(source_dir):
-        source = source_dir + "/" + file
-        dest = dest_dir + "/" + file
-        if is_excluded(exclude_directories, source):
-            print(f"{bcolors.VERBOSE}[*] Skipping {source}...{bcolors.ENDC}")
-            continue
-        if os.path.isdir(source):
-            copy_dir(source, dest, exclude_directories)
-        else:
-            #try:
-            if not is_same_file(source, dest):
-                if os.path.islink(source):
-                    copy_symlink(source, dest)
-                else:
-                        shutil.copy(source, dest)
+    with os.scandir(source_dir) as it:
+        for entry in it:
+            # entries named exactly like a pattern (node_modules, .git, ...) are
+            # caught by a set lookup before the substring search
+            if entry.name in exclude_names or is_excluded(excludes, entry.path):
+                print(f"{bcolors.VERBOSE}[*] Skipping {entry.path}...{bcolors.ENDC}")
+                continue
+            dest = f"{dest_dir}/{entry.name}"
+            if entry.is_dir():
+                collect_copy_jobs(entry.path, dest, excludes, jobs, exclude_names)
             else:
-                print(f"{bcolors.VERBOSE}[*] Same already: {source}.{bcolors.ENDC}")
+                jobs.append((entry, dest))
+
+def copy_file(entry, dest):
+    if entry.is_symlink():
+        copy_symlink(entry.path, dest)
+    else:
+        fast_copy(entry.path, dest)
 
-            #except FileNotFoundError:
-            #    print(f"{bcolors.WARNING}[!] Could not copy {source}!{bcolors.ENDC}")
+# this copies the directory while leaving the additional files 
+# that are already in the dest in place
+# if the destination is an sshfs mount of remote_host:remote_path the file
+# contents are compared by hashing the destination files on the remote host
+def copy_dir(source_dir, dest_dir, exclude_directories = [], remote_host = None, remote_path = None, control_path = None):
+    jobs = []
+    # without a trailing slash we can simply append "/name" during the walk
+    dest_dir = dest_dir.rstrip("/") or "/"
+    collect_copy_jobs(source_dir, dest_dir, compile_excludes(exclude_directories), jobs,
+                      frozenset(exclude_directories))
+
+    # comparing and copying is mostly waiting for I/O (especially on sshfs),
+    # so a thread pool scales well here
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=COPY_WORKERS)
+    try:
+        same = list(executor.map(lambda job: compare_entry(*job), jobs))
+
+        # only the files whose metadata was inconclusive need to be hashed
+        undecided = [i for i, s in enumerate(same) if s is None]
+        pairs = [(jobs[i][0].path, jobs[i][1]) for i in undecided]
+        for i, is_same in zip(undecided, compare_contents(executor, pairs, dest_dir, remote_host, remote_path, control_path)):
+            same[i] = is_same
+
+        futures = []
+        for job, is_same in zip(jobs, same):
+            if is_same:
+                print(f"{bcolors.VERBOSE}[*] Same already: {job[0].path}.{bcolors.ENDC}")
+            else:
+                futures.append(executor.submit(copy_file, *job))
+        for future in futures:
+            future.result()
+    except BaseException:
+        # do not work through the queued jobs on Ctrl-C or errors
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
 
 class FileSyncher(FileSystemEventHandler):
 
@@ -98,43 +382,177 @@ class FileSyncher(FileSystemEventHandler):
         self.remote_path = remote_path
         self.verbose = verbose
         self.exclude_directories = exclude_directories
+        self.excludes = compile_excludes(exclude_directories)
+        # event paths start with the local path; strip/prepend these prefixes
+        self.local_prefix = local_path.rstrip("/") + "/"
+        self.remote_prefix = remote_path.rstrip("/") + "/"
+        self.observer = None
+        # watches of the top level directories, only used with inotify
+        self.subtree_watches = {}
+        self.watch_top_level = False
+
+        # files to copy once they stopped changing: path -> (deadline, created)
+        self.pending = {}
+        # paths taken from pending whose copy has not finished yet
+        self.in_flight = set()
+        self.pending_cond = threading.Condition()
+        # (size, mtime_ns) of the most recent copy of a file
+        self.copied = collections.OrderedDict()
+        # serializes the changes to the remote directory
+        self.remote_lock = threading.Lock()
+        self.stopped = False
+        self.copy_thread = threading.Thread(target=self.copy_pending, daemon=True)
+        self.copy_thread.start()
+
+    def stop(self):
+        # copies whatever is still pending and stops the copy thread
+        with self.pending_cond:
+            self.stopped = True
+            self.pending_cond.notify()
+        self.copy_thread.join()
+
+    def watch(self, observer):
+        self.observer = observer
+        if not sys.platform.startswith("linux"):
+            # FSEvents (macOS) and Windows watch recursively on their own
+            observer.schedule(self, self.local_path, recursive=True)
+            return
+
+        # inotify needs one watch per directory. hence, we only watch the top
+        # level itself and every top level directory that is not excluded, so
+        # that excluded trees like node_modules are never added.
+        self.watch_top_level = True
+        observer.schedule(self, self.local_path, recursive=False)
+        with os.scandir(self.local_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False) and not self.is_excluded(entry.path):
+                    self.watch_subtree(entry.path)
+
+    def is_top_level(self, path):
+        return os.path.normpath(os.path.dirname(path)) == os.path.normpath(self.local_path)
+
+    def watch_subtree(self, path):
+        # events report paths based on the watched path, so we schedule the path
+        # as is to keep the local prefix
+        key = os.path.normpath(path)
+        if key not in self.subtree_watches:
+            self.subtree_watches[key] = self.observer.schedule(self, path, recursive=True)
+
+    def unwatch_subtree(self, path):
+        watch = self.subtree_watches.pop(os.path.normpath(path), None)
+        if watch is not None:
+            try:
+                self.observer.unschedule(watch)
+            except KeyError:
+                # the watch already stopped itself as the directory is gone
+                pass
 
     def is_excluded(self, file):
-        return is_excluded(self.exclude_directories, file)
+        return is_excluded(self.excludes, file)
         
     def get_relative_path(self, remote_path):
+        if remote_path.startswith(self.local_prefix):
+            return remote_path[len(self.local_prefix):]
         return os.path.relpath(remote_path, self.local_path)
 
     def delete_file_or_folder(self, path):
-        try:
-            os.remove(path)
-        except IsADirectoryError:
+        if stat.S_ISDIR(os.lstat(path).st_mode):
             shutil.rmtree(path)
+        else:
+            os.unlink(path)
 
     def copy_file_or_folder(self, src_path, dest_path):
-        if os.path.islink(src_path):
+        mode = os.lstat(src_path).st_mode
+        if stat.S_ISLNK(mode):
             copy_symlink(src_path, dest_path)
-            return
-            
-        try:
-            # try copytree first as it also handles symlinks
-            shutil.copytree(src_path, dest_path)
-        except NotADirectoryError:
-            shutil.copy(src_path, dest_path)
+        elif stat.S_ISDIR(mode):
+            shutil.copytree(src_path, dest_path, copy_function=fast_copy, dirs_exist_ok=True)
+        else:
+            fast_copy(src_path, dest_path)
         
+    def schedule_copy(self, path, created):
+        with self.pending_cond:
+            # a modification does not turn a pending creation into an update
+            created = created or self.pending.get(path, (None, False))[1]
+            self.pending[path] = (time.monotonic() + COPY_DELAY, created)
+            self.pending_cond.notify()
+
+    def drop_pending(self, path):
+        with self.pending_cond:
+            for pending_path in list(self.pending):
+                if pending_path == path or pending_path.startswith(path + "/"):
+                    del self.pending[pending_path]
+
+    def move_pending(self, src_path, dest_path):
+        with self.pending_cond:
+            for pending_path in list(self.pending):
+                if pending_path == src_path or pending_path.startswith(src_path + "/"):
+                    deadline, _ = self.pending.pop(pending_path)
+                    # the remote never got the file, so it has to be created
+                    self.pending[dest_path + pending_path[len(src_path):]] = (deadline, True)
+            # a copy in flight may miss the moved file, so we return the new
+            # paths that have to be copied again once the remote file was moved
+            return [dest_path + copying_path[len(src_path):] for copying_path in self.in_flight
+                    if copying_path == src_path or copying_path.startswith(src_path + "/")]
+
+    def take_due_copies(self):
+        now = time.monotonic()
+        due = [path for path, (deadline, _) in self.pending.items()
+               if deadline <= now or self.stopped]
+        self.in_flight.update(due)
+        return [(path, self.pending.pop(path)[1]) for path in due]
+
+    def copy_pending(self):
+        while True:
+            with self.pending_cond:
+                copies = self.take_due_copies()
+                while not copies:
+                    if self.stopped:
+                        return
+                    timeout = None
+                    if self.pending:
+                        timeout = min(deadline for deadline, _ in self.pending.values()) - time.monotonic()
+                    self.pending_cond.wait(timeout)
+                    copies = self.take_due_copies()
+
+            for path, created in copies:
+                try:
+                    with self.remote_lock:
+                        self.copy_to_remote(path, created)
+                except FileNotFoundError:
+                    # file does not exist; probably already deleted
+                    pass
+                except OSError as e:
+                    print(f"{bcolors.WARNING}[!] Could not copy {path}: {e}{bcolors.ENDC}")
+                finally:
+                    with self.pending_cond:
+                        self.in_flight.discard(path)
+
+    def copy_to_remote(self, path, created):
+        dest_path = self.remote_prefix + self.get_relative_path(path)
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode):
+            # modified directories (i.e., their entries) are handled by their own events
+            if created:
+                self.copy_file_or_folder(path, dest_path)
+            return
+
+        # skip files that did not change since we copied them the last time
+        snapshot = (st.st_size, st.st_mtime_ns)
+        if self.copied.get(path) == snapshot:
+            return
+        fast_copy(path, dest_path)
+        self.copied[path] = snapshot
+        self.copied.move_to_end(path)
+        if len(self.copied) > COPIED_SNAPSHOTS:
+            self.copied.popitem(last=False)
+
     def on_modified(self, event):
         if self.is_excluded(event.src_path):
             return
 
         if self.verbose: print(f"[+] Updating {event.src_path}")
-
-        if os.path.isfile(event.src_path):
-            file_relpath = self.get_relative_path(event.src_path)
-            try:
-                shutil.copy(event.src_path, self.remote_path + "/" + file_relpath)
-            except FileNotFoundError:
-                # file does not exist; probably already deleted
-                pass
+        self.schedule_copy(event.src_path, False)
     
     def on_created(self, event):
         if self.is_excluded(event.src_path):
@@ -142,22 +560,24 @@ class FileSyncher(FileSystemEventHandler):
 
         if self.verbose: print(f"[+] Creating {event.src_path}")
 
-        file_relpath = self.get_relative_path(event.src_path)
-        try:
-            self.copy_file_or_folder(event.src_path, self.remote_path + "/" + file_relpath)
-        except FileNotFoundError:
-            # file does not exist; probably already deleted
-            pass
+        if self.watch_top_level and event.is_directory and self.is_top_level(event.src_path):
+            self.watch_subtree(event.src_path)
+
+        self.schedule_copy(event.src_path, True)
     
     def on_deleted(self, event):
         if self.is_excluded(event.src_path):
             return
 
         if self.verbose: print(f"[+] Deleting {event.src_path}")
+        self.unwatch_subtree(event.src_path)
+        self.drop_pending(event.src_path)
         file_relpath = self.get_relative_path(event.src_path)
 
         try: 
-            self.delete_file_or_folder(self.remote_path + "/" + file_relpath)
+            with self.remote_lock:
+                self.copied.pop(event.src_path, None)
+                self.delete_file_or_folder(self.remote_prefix + file_relpath)
         except FileNotFoundError:
             # file does not exist; so we dont need to delete
             pass
@@ -168,13 +588,26 @@ class FileSyncher(FileSystemEventHandler):
 
         if self.verbose: print(f"[+] Moving {event.src_path} to {event.dest_path}")
 
+        # the inotify watch follows the directory, but would report the old paths
+        if os.path.normpath(event.src_path) in self.subtree_watches:
+            self.unwatch_subtree(event.src_path)
+            if self.is_top_level(event.dest_path) and not self.is_excluded(event.dest_path):
+                self.watch_subtree(event.dest_path)
+
+        recopy_paths = self.move_pending(event.src_path, event.dest_path)
         src_relpath = self.get_relative_path(event.src_path)
         dest_relpath = self.get_relative_path(event.dest_path)
         try:
-            shutil.move(self.remote_path + "/" + src_relpath, self.remote_path + "/" + dest_relpath)
+            with self.remote_lock:
+                self.copied.pop(event.src_path, None)
+                shutil.move(self.remote_prefix + src_relpath, self.remote_prefix + dest_relpath)
         except FileNotFoundError:
-            # file does not exist; probably already deleted
-            pass
+            # the remote never got the file (e.g., its copy was still in flight),
+            # so we copy it under its new name unless it is gone locally as well
+            if os.path.lexists(event.dest_path):
+                self.schedule_copy(event.dest_path, True)
+        for path in recopy_paths:
+            self.schedule_copy(path, True)
         
 
 def parse_arguments() -> dict:
@@ -203,18 +636,65 @@ def parse_arguments() -> dict:
 
     return vars(parser.parse_args())
 
-    
-def create_sshfs_mount(local_path, remote_path, remote_host):
-    p = subprocess.run(["sshfs", f"{remote_host}:{remote_path}", local_path])
 
+# rsync matches exclude patterns as globs; wrapping the escaped pattern in
+# "**" gives the same substring semantics as is_excluded
+def rsync_exclude(exclude):
+    escaped = "".join("\\" + c if c in "*?[\\" else c for c in exclude)
+    return f"--exclude=**{escaped}**"
+
+# syncs the directory to the remote host with rsync, which only transfers
+# the differences. returns False if rsync is not available or failed.
+def rsync_dir(source_dir, remote_host, remote_path, exclude_directories, control_path = None):
+    if shutil.which("rsync") is None:
+        return False
+
+    command = ["rsync", "-a", "-e", shlex.join(ssh_command(None, control_path))]
+    command += [rsync_exclude(exclude) for exclude in exclude_directories]
+    command += [source_dir.rstrip("/") + "/", f"{remote_host}:{remote_path}/"]
+    p = subprocess.run(command)
     if p.returncode != 0:
-        # probably the directory does not exist, hence we just try to create it.
-        subprocess.run(["ssh", remote_host, f"mkdir {remote_path}"])
-        p = subprocess.run(["sshfs", f"{remote_host}:{remote_path}", local_path])
-        
+        print(f"{bcolors.WARNING}[!] rsync failed, falling back to copying via sshfs...{bcolors.ENDC}")
+        return False
+    return True
+
+
+# all ssh connections to the remote host are multiplexed over one master
+# connection, so they do not need a handshake of their own
+def start_ssh_master(remote_host, control_path):
+    p = subprocess.run(["ssh", "-M", "-N", "-f", "-S", control_path, "-o", "ControlPersist=yes", remote_host])
+    return p.returncode == 0
+
+def stop_ssh_master(remote_host, control_path):
+    subprocess.run(["ssh", "-S", control_path, "-O", "exit", remote_host], stderr=subprocess.DEVNULL)
+
+# the ssh command line, without the host if remote_host is None
+def ssh_command(remote_host, control_path = None):
+    command = ["ssh"]
+    if control_path is not None:
+        command += ["-S", control_path]
+    if remote_host is not None:
+        command.append(remote_host)
+    return command
+
+def sshfs_command(local_path, remote_path, remote_host, control_path = None):
+    command = ["sshfs", f"{remote_host}:{remote_path}", local_path]
+    if control_path is not None:
+        command += ["-o", "ssh_command=" + " ".join(ssh_command(None, control_path))]
+    return command
+    
+def create_sshfs_mount(local_path, remote_path, remote_host, control_path = None):
+    # create the remote directory if needed and check it in a single round trip
+    quoted_path = shlex.quote(remote_path)
+    p = subprocess.run(ssh_command(remote_host, control_path) +
+                       [f"mkdir -p {quoted_path} && test -d {quoted_path}"])
+    if p.returncode != 0:
+        print(f"{bcolors.FAIL}[!] Failed to create the remote directory {remote_path} on {remote_host}. Aborting!{bcolors.ENDC}")
+        exit(1)
+
+    p = subprocess.run(sshfs_command(local_path, remote_path, remote_host, control_path))
     if p.returncode != 0:
         print(f"{bcolors.FAIL}[!] Failed to create sshfs directory. Aborting!{bcolors.ENDC}")
-        print(f"{bcolors.FAIL}[!] Does the remote directory exist? If not, create it!")
         print(f"{bcolors.FAIL}[!] Command used: sshfs {remote_host}:{remote_path} {local_path}")
         exit(1)
 
@@ -223,6 +703,20 @@ def remove_sshfs_mount(local_path):
     if p.returncode != 0:
         print(f"{bcolors.FAIL}[!] Failed to cleanup sshfs directory!{bcolors.ENDC}")
 
+def remove_sshfs_directory(local_path):
+    # the directory is empty once it is unmounted, but the unmount may take a
+    # moment. rmdir (unlike rmtree) can never delete remote files meanwhile.
+    for attempt in range(5):
+        try:
+            os.rmdir(local_path)
+            return
+        except OSError:
+            if attempt == 0:
+                # the mount is probably still busy, so we detach it lazily
+                subprocess.run(["fusermount3", "-u", "-z", local_path], stderr=subprocess.DEVNULL)
+            time.sleep(0.1)
+    print(f"{bcolors.FAIL}[!] Failed to remove sshfs directory {local_path}!{bcolors.ENDC}")
+
 
     
 def main():
@@ -231,20 +725,33 @@ def main():
 
     local_path = arg_dict["source"]
 
+    load_hash_cache(local_path)
+    atexit.register(save_hash_cache)
+
     if ":" in arg_dict["destination"]:
         remote_connection_used = True
         # parse host
         remote_host, remote_path = arg_dict["destination"].split(":")
 
+        # open one ssh connection that is reused by all following ssh calls
+        control_directory = tempfile.mkdtemp(prefix="dirsyncher-ssh-")
+        atexit.register(shutil.rmtree, control_directory, ignore_errors=True)
+        control_path = control_directory + "/master.sock"
+        if start_ssh_master(remote_host, control_path):
+            atexit.register(stop_ssh_master, remote_host, control_path)
+        else:
+            print(f"{bcolors.WARNING}[!] Could not open an ssh master connection, using separate connections...{bcolors.ENDC}")
+            control_path = None
+
         # create an sshfs
-        sshfs_temp_directory = tempfile.mktemp()
-        os.mkdir(sshfs_temp_directory)
-        create_sshfs_mount(sshfs_temp_directory, remote_path, remote_host)
+        sshfs_temp_directory = tempfile.mkdtemp(prefix="dirsyncher-")
+        create_sshfs_mount(sshfs_temp_directory, remote_path, remote_host, control_path)
 
         # let the remote path point to the sshfs directory
         remote_path_org = remote_path
         remote_path = sshfs_temp_directory
     else:
+        remote_connection_used = False
         remote_path_org = arg_dict["destination"]
         remote_path = arg_dict["destination"]
 
@@ -260,32 +767,43 @@ def main():
         exclude_directories = list([arg_dict["exclude"]])
 
     print(f"{bcolors.OKBLUE}[!] Initializing...{bcolors.ENDC}")
-    copy_dir(local_path, remote_path, exclude_directories)
+    # rsync is much faster than copying through sshfs, which is only needed
+    # for syncing the changes afterwards
+    if not remote_connection_used:
+        copy_dir(local_path, remote_path, exclude_directories)
+    elif not rsync_dir(local_path, remote_host, remote_path_org, exclude_directories, control_path):
+        copy_dir(local_path, remote_path, exclude_directories, remote_host, remote_path_org, control_path)
     print(f"{bcolors.OKBLUE}[!] Copy finished...{bcolors.ENDC}")
+
+    # block the stop signals before starting any thread, so that all threads
+    # inherit the mask and the main thread can simply wait for them below
+    stop_signals = {signal.SIGINT, signal.SIGTERM}
+    signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
     
     event_handler = FileSyncher(local_path, remote_path, arg_dict["verbose"], exclude_directories)
 
     observer = Observer()
-    observer.schedule(event_handler, local_path, recursive=True)
+    event_handler.watch(observer)
     observer.start()
 
     # print it here after we started running cause the initial copy can take some time
     if remote_connection_used:
         print(f"{bcolors.OKGREEN}[+] Syncing from {local_path} to {remote_path_org} (on {remote_host}){bcolors.ENDC}")
+        print(f"{bcolors.OKBLUE}[*] Using local directory: {sshfs_temp_directory}{bcolors.ENDC}")
     else:
         print(f"{bcolors.OKGREEN}[+] Syncing from {local_path} to {remote_path_org} (local){bcolors.ENDC}")
-    print(f"{bcolors.OKBLUE}[*] Using local directory: {sshfs_temp_directory}{bcolors.ENDC}")
+    # the observer runs in its own thread, so we just sleep until we are told to stop
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        pass
+        signal.sigwait(stop_signals)
     finally:
-        if remote_connection_used:
-            remove_sshfs_mount(sshfs_temp_directory)
-            shutil.rmtree(sshfs_temp_directory)
+        # another Ctrl-C aborts the cleanup (e.g., if the connection is dead)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
         observer.stop()
         observer.join()
+        event_handler.stop()
+        if remote_connection_used:
+            remove_sshfs_mount(sshfs_temp_directory)
+            remove_sshfs_directory(sshfs_temp_directory)
 
     
 